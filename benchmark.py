@@ -0,0 +1,256 @@
+"""アップロード処理のベンチマーク
+
+合成した売上CSVを FastAPI の TestClient で /upload-and-generate へ送り、
+読み込み・集計・描画・書き込みの時間とピークRSSを JSON で出力する。
+
+TestClient を使うので httpx が必要（requirements.txt に含む）。
+
+メモリの値（MB。Windows では測れないので出さない）:
+    baseline_rss_mb    アプリを import した直後のRSS
+    peak_rss_mb        ケース全体のピークRSS。TestClient はリクエスト本文を丸ごとメモリに
+                       読み込むため、その分（CSVのサイズ程度）も含まれる
+    ingest_rss_mb      読み込み・集計の直前のRSS
+    ingest_peak_rss_mb 読み込み・集計中のピークRSS
+    ingest_delta_mb    読み込み・集計で増えたピークRSS（サーバー側の処理だけの使用量）
+
+    python benchmark.py --rows 10000 100000 1000000 --products 10 1000 100000 --output bench.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SUBCATEGORIES = ['パン', '弁当', 'おにぎり', 'サラダ', '惣菜', '飲料', '菓子', 'デザート', '乳製品', '冷凍食品']
+WEEKDAYS = ['月', '火', '水', '木', '金', '土', '日']
+DISCOUNT_RATES = [0.0, 0.1, 0.2, 0.3, 0.5]
+WASTE_RATES = [0.0, 0.02, 0.05, 0.1, 0.2]
+
+
+def generate_sales_csv(path, rows, products, subcategories=8, seed=0, chunk_rows=500_000, zipf_s=1.0):
+    """必須カラムを持つ売上CSVをチャンクごとに書き出す（行数が多くてもメモリは一定）"""
+    rng = np.random.default_rng(seed)
+    names = np.array([f"商品{i:06d}" for i in range(products)])
+    # 商品の売れ行きは人気順位の Zipf 分布（順位 r の重みは 1/r^s）。順位は商品にランダムに割り当てる
+    rank = rng.permutation(products)
+    popularity = 1.0 / (rank + 1.0) ** zipf_s
+    popularity /= popularity.sum()
+    # 人気の高い商品から順に、売上の比率がいちばん小さいサブカテゴリへ配る（行数がほぼ均等になる）
+    shares = np.zeros(min(subcategories, len(SUBCATEGORIES)))
+    product_subcategory = np.empty(products, dtype=int)
+    for product in np.argsort(rank):
+        product_subcategory[product] = sub = shares.argmin()
+        shares[sub] += popularity[product]
+    base_price = rng.integers(100, 1500, products)
+
+    written = 0
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        while written < rows:
+            n = min(chunk_rows, rows - written)
+            product = rng.choice(products, n, p=popularity)
+            discount = rng.choice(DISCOUNT_RATES, n)
+            temperature = rng.normal(20, 8, n).round(1)
+            quantity = rng.poisson(3, n) + 1
+            chunk = pd.DataFrame({
+                'サブカテゴリ': np.array(SUBCATEGORIES)[product_subcategory[product]],
+                '曜日': rng.choice(WEEKDAYS, n),
+                '値引き率': discount,
+                '廃棄率': rng.choice(WASTE_RATES, n),
+                '最高気温': temperature,
+                '商品名': names[product],
+                '売上金額': (base_price[product] * quantity * (1 - discount)).round(),
+            })
+            chunk.to_csv(f, index=False, header=written == 0)
+            written += n
+    return path
+
+
+def _reset_peak_rss():
+    """Linux ではピークRSS（VmHWM）をリセットできる。fork 元の使用量を引き継がないようにする"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _proc_status_mb(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _peak_rss_mb():
+    """ピークRSS（MB）。測れない環境（Windows）では None"""
+    peak = _proc_status_mb("VmHWM")
+    if peak is not None:
+        return peak
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Linux は KB、macOS はバイト単位
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def _run_case(csv_path, use_pool):
+    """1ケースを新しいプロセスで実行する（ピークRSSをケースごとに測るため）"""
+    os.chdir(REPO_DIR)
+    sys.path.insert(0, REPO_DIR)
+    # アプリのログで結果のJSONが崩れないようにする
+    sys.stdout = sys.stderr
+    from fastapi.testclient import TestClient
+    import main
+
+    # 読み込み・集計だけのメモリ使用量を、リクエスト本文のコピーと分けて測る
+    ingest = {}
+    ingest_csv = main.ingest_csv
+
+    def measured_ingest_csv(*args, **kwargs):
+        ingest["before"] = _proc_status_mb("VmRSS")
+        # ケース全体のピークを失わないよう、リセット前の値を残しておく
+        ingest["peak_before"] = _peak_rss_mb()
+        _reset_peak_rss()
+        try:
+            return ingest_csv(*args, **kwargs)
+        finally:
+            ingest["peak"] = _proc_status_mb("VmHWM")
+
+    main.ingest_csv = measured_ingest_csv
+
+    _reset_peak_rss()
+    rss_before = _peak_rss_mb()
+    client = TestClient(main.app)
+    if use_pool:
+        client.__enter__()
+    try:
+        start = time.perf_counter()
+        with open(csv_path, "rb") as f:
+            r = client.post("/upload-and-generate", files={"file": (os.path.basename(csv_path), f, "text/csv")})
+        total_ms = (time.perf_counter() - start) * 1000
+    finally:
+        if use_pool:
+            client.__exit__(None, None, None)
+
+    result = {
+        "status": r.status_code,
+        "total_ms": round(total_ms, 1),
+    }
+    peak = _peak_rss_mb()
+    if peak is not None:
+        result["peak_rss_mb"] = round(max(peak, ingest.get("peak_before") or 0), 1)
+        result["baseline_rss_mb"] = round(rss_before, 1)
+    # /proc がない環境ではピークをリセットできないので出さない
+    if ingest.get("before") is not None and ingest.get("peak") is not None:
+        result["ingest_rss_mb"] = round(ingest["before"], 1)
+        result["ingest_peak_rss_mb"] = round(ingest["peak"], 1)
+        result["ingest_delta_mb"] = round(ingest["peak"] - ingest["before"], 1)
+    for part in r.headers.get("server-timing", "").split(","):
+        name, _, dur = part.strip().partition(";dur=")
+        if dur:
+            result[f"{name}_ms"] = float(dur)
+    body = r.json()
+    if r.status_code != 200:
+        result["error"] = body.get("error")
+        return result
+    result["charts"] = [
+        {key: item[key] for key in ("title", "render_ms", "write_ms", "bytes")} for item in body
+    ]
+    # 後片付け
+    for item in body:
+        try:
+            os.remove(os.path.join(main.IMAGE_DIR, os.path.basename(item["url"])))
+        except FileNotFoundError:
+            pass
+    return result
+
+
+def run_benchmark(rows_list, products_list, repeat=1, use_pool=False, data_dir=None, seed=0):
+    # 描画時間も測るため、アップロード時に全グラフを描画させる（子プロセスへ引き継がれる）
+    os.environ.setdefault("CHART_RENDERING", "eager")
+    ctx = multiprocessing.get_context("spawn")
+    runs = []
+    with tempfile.TemporaryDirectory(dir=data_dir) as tmp:
+        for rows in rows_list:
+            for products in products_list:
+                csv_path = os.path.join(tmp, f"bench_{rows}_{products}.csv")
+                start = time.perf_counter()
+                generate_sales_csv(csv_path, rows, products, seed=seed)
+                generate_ms = (time.perf_counter() - start) * 1000
+                for i in range(repeat):
+                    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                        result = pool.submit(_run_case, csv_path, use_pool).result()
+                    result.update(
+                        rows=rows,
+                        products=products,
+                        repeat=i,
+                        file_bytes=os.path.getsize(csv_path),
+                        generate_ms=round(generate_ms, 1),
+                    )
+                    print(
+                        f"rows={rows} products={products} #{i}: {result['total_ms']:.0f}ms "
+                        f"peak_rss={result.get('peak_rss_mb', 0):.0f}MB ingest_delta={result.get('ingest_delta_mb', 0):.0f}MB "
+                        f"status={result['status']}",
+                        file=sys.stderr,
+                    )
+                    runs.append(result)
+    return runs
+
+
+def environment():
+    import matplotlib
+    import seaborn
+
+    env = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "matplotlib": matplotlib.__version__,
+        "seaborn": seaborn.__version__,
+    }
+    for name in ("CHART_RENDERING", "RENDER_MODE", "RENDER_WORKERS", "IMAGE_FORMAT", "IMAGE_DPI", "PNG_COMPRESSION", "CSV_CHUNK_ROWS"):
+        if name in os.environ:
+            env[name] = os.environ[name]
+    return env
+
+
+def main():
+    parser = argparse.ArgumentParser(description="アップロード処理のベンチマーク")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000], help="行数（10k〜10M）")
+    parser.add_argument("--products", type=int, nargs="+", default=[100], help="商品数（10〜100k）")
+    parser.add_argument("--repeat", type=int, default=1, help="各ケースの繰り返し回数")
+    parser.add_argument("--pool", action="store_true", help="描画プロセスプールを起動して計測する")
+    parser.add_argument("--data-dir", help="合成CSVを書き出すディレクトリ（既定は一時ディレクトリ）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="結果JSONの出力先（省略時は標準出力）")
+    args = parser.parse_args()
+
+    runs = run_benchmark(args.rows, args.products, args.repeat, args.pool, args.data_dir, args.seed)
+    report = {"environment": environment(), "runs": runs}
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,141 +1,1428 @@
+import io
 import os
+import asyncio
+import chardet
+import cProfile
+import hashlib
+import json
+import pickle
+import pstats
+import threading
+import time
 import uuid
+import multiprocessing
+import re
+import functools
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import asynccontextmanager
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.figure import Figure
+from matplotlib.textpath import TextToPath
+from matplotlib.ticker import ScalarFormatter
 import seaborn as sns
-from fastapi import FastAPI, UploadFile, File
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, File, Query, Request
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from starlette.staticfiles import StaticFiles
 import matplotlib.font_manager as fm
+from metrics import REGISTRY
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app):
+    start_render_pool()
+    start_image_sweeper()
+    yield
+    stop_image_sweeper()
+    stop_render_pool()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # フォント設定（日本語対応）
 font_path = "./fonts/NotoSansJP-Regular.ttf"
 if os.path.exists(font_path):
     fm.fontManager.addfont(font_path)
-    plt.rcParams['font.family'] = 'Noto Sans JP'
+    matplotlib.rcParams['font.family'] = 'Noto Sans JP'
 else:
     print("⚠️ フォントファイルが見つかりません")
 
 UPLOAD_DIR = "uploads"
 IMAGE_DIR = "images"
+# グラフ描画用の集計結果の保存先（再起動後や別プロセスでも /charts のURLから描画できるようにする）
+DATASET_DIR = "datasets"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(IMAGE_DIR, exist_ok=True)
+os.makedirs(DATASET_DIR, exist_ok=True)
+
+# 棒グラフに95%信頼区間を描くか（集計値からの正規近似。ブートストラップはしない）
+CHART_ERRORBARS = os.environ.get("CHART_ERRORBARS", "0") == "1"
+# 散布図に使う最大サンプル数
+SCATTER_SAMPLE_SIZE = int(os.environ.get("SCATTER_SAMPLE_SIZE", "5000"))
+# 箱ひげ図の四分位・ひげ・外れ値を求めるための 曜日×サブカテゴリ ごとの最大サンプル数
+BOX_SAMPLE_SIZE = int(os.environ.get("BOX_SAMPLE_SIZE", "2000"))
+# アップロードをディスクへ書き出す単位（バイト）
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# CSVを読み込む単位（行）
+CSV_CHUNK_ROWS = int(os.environ.get("CSV_CHUNK_ROWS", "200000"))
+# 文字コード判定に使う先頭バイト数
+ENCODING_SAMPLE_SIZE = 64 * 1024
+# 生成結果キャッシュの最大件数と保持期間（秒）
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "100"))
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", str(24 * 60 * 60)))
+# グラフ描画プロセス数（0 ならリクエストのスレッド内で順に描画する）
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", str(min(os.cpu_count() or 1, 10))))
+# 描画モード: standard は毎回 Figure を作り bbox_inches='tight' で保存、
+# fast はグラフごとの Figure を使い回し、余白は目盛りラベルの長さから見積もって保存する
+RENDER_MODE = os.environ.get("RENDER_MODE", "standard")
+# 画像の形式（png / webp / svg）・解像度・圧縮率。fast は既定の解像度を下げて画像も軽くする
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "png")
+IMAGE_DPI = int(os.environ.get("IMAGE_DPI", "80" if RENDER_MODE == "fast" else "100"))
+PNG_COMPRESSION = int(os.environ.get("PNG_COMPRESSION", "6"))
+WEBP_QUALITY = int(os.environ.get("WEBP_QUALITY", "80"))
+# バックグラウンドで同時に処理するジョブ数と、待たせておけるジョブ数
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_QUEUE_DEPTH = int(os.environ.get("JOB_QUEUE_DEPTH", "8"))
+# 完了したジョブの結果を保持する期間（秒）
+JOB_TTL = int(os.environ.get("JOB_TTL", str(60 * 60)))
+# 進捗をストリームするときの確認間隔（秒）
+JOB_POLL_INTERVAL = 0.2
+# アップロード済みデータセットを保持するメモリ上限（バイト）と保持期間（秒）
+DATASET_STORE_BYTES = int(os.environ.get("DATASET_STORE_BYTES", str(512 * 1024 * 1024)))
+DATASET_TTL = int(os.environ.get("DATASET_TTL", str(60 * 60)))
+# 1件のアップロードで集計前データを保持する上限（バイト）。超えたら集計結果だけを保持する
+DATASET_UPLOAD_BYTES = int(os.environ.get("DATASET_UPLOAD_BYTES", str(64 * 1024 * 1024)))
+
+# 画像URLの先頭部分
+PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL", "https://graph-api2.onrender.com").rstrip("/")
+# lazy はアップロード時に集計だけを行い、各グラフは初めてURLが要求されたときに描画する
+# eager はアップロード時に全グラフを描画する
+CHART_RENDERING = os.environ.get("CHART_RENDERING", "lazy")
+# /charts で返す画像のブラウザ・CDNキャッシュ期間（秒）
+CHART_MAX_AGE = int(os.environ.get("CHART_MAX_AGE", str(24 * 60 * 60)))
+# IMAGE_DIR の容量上限（バイト）と、超過を確認する間隔（秒）
+IMAGE_DIR_QUOTA_BYTES = int(os.environ.get("IMAGE_DIR_QUOTA_BYTES", str(1024 * 1024 * 1024)))
+IMAGE_SWEEP_INTERVAL = int(os.environ.get("IMAGE_SWEEP_INTERVAL", "60"))
+# DATASET_DIR の容量上限（バイト）。IMAGE_DIR と同じ間隔で確認する
+DATASET_DIR_QUOTA_BYTES = int(os.environ.get("DATASET_DIR_QUOTA_BYTES", str(256 * 1024 * 1024)))
+# profile=true のときに返すプロファイル結果の行数
+PROFILE_TOP_N = int(os.environ.get("PROFILE_TOP_N", "30"))
 
 app.mount("/images", StaticFiles(directory=IMAGE_DIR), name="images")
 
-df_cache = None
+stage_seconds = REGISTRY.histogram("graph_api_stage_seconds", "パイプライン各段階の処理時間（秒）", ["stage"])
+chart_seconds = REGISTRY.histogram("graph_api_chart_seconds", "グラフ1枚の描画・書き込み時間（秒）", ["chart", "step"])
+upload_bytes = REGISTRY.counter("graph_api_upload_bytes_total", "アップロードされたバイト数")
+rows_processed = REGISTRY.counter("graph_api_rows_processed_total", "集計した行数")
+images_written = REGISTRY.counter("graph_api_images_written_total", "書き出した画像の枚数", ["chart"])
+image_bytes = REGISTRY.counter("graph_api_image_bytes_total", "書き出した画像のバイト数", ["chart"])
+chart_errors = REGISTRY.counter("graph_api_chart_errors_total", "描画に失敗したグラフの数", ["chart"])
+cache_requests = REGISTRY.counter("graph_api_cache_requests_total", "結果キャッシュの参照回数", ["result"])
+request_errors = REGISTRY.counter("graph_api_request_errors_total", "エラーで終わった処理の数", ["endpoint", "status"])
+images_evicted = REGISTRY.counter("graph_api_images_evicted_total", "容量上限のために削除した画像の枚数")
+datasets_evicted = REGISTRY.counter("graph_api_datasets_evicted_total", "容量上限のために削除した集計結果の件数")
 
-@app.post("/upload-and-generate")
-def upload_and_generate(file: UploadFile = File(...)):
-    global df_cache
+required_columns = ['サブカテゴリ', '曜日', '値引き率', '廃棄率', '最高気温', '商品名', '売上金額']
+column_dtypes = {
+    'サブカテゴリ': 'category',
+    '曜日': 'category',
+    '商品名': 'category',
+    # 率はグラフのラベルになるので、float32 の誤差（0.10000000149…）が出ないよう float64 のまま読む
+    '値引き率': 'float64',
+    '廃棄率': 'float64',
+    '最高気温': 'float32',
+    '売上金額': 'float32',
+}
+# 期間での絞り込みに使う任意カラム
+date_column = '日付'
+
+
+def save_upload(src, path, chunk_size=UPLOAD_CHUNK_SIZE):
+    """アップロードを一定サイズずつディスクへ書き出し、内容の SHA-256 を返す"""
+    digest = hashlib.sha256()
+    with open(path, "wb") as buffer:
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            buffer.write(chunk)
+    return digest.hexdigest()
+
+
+def detect_encoding(path, sample_size=ENCODING_SAMPLE_SIZE):
+    """先頭の一部だけを読んで文字コードを推定する"""
+    with open(path, "rb") as f:
+        sample = f.read(sample_size)
+    if sample.startswith(b"\xef\xbb\xbf"):
+        return "utf-8-sig"
     try:
-        # ファイル保存
-        csv_path = os.path.join(UPLOAD_DIR, file.filename)
-        with open(csv_path, "wb") as buffer:
-            buffer.write(file.file.read())
-
-        # CSV読み込み
-        df = pd.read_csv(csv_path)
-        df_cache = df
-
-        # 必須カラムチェック
-        required_columns = ['サブカテゴリ', '曜日', '値引き率', '廃棄率', '最高気温', '商品名', '売上金額']
-        for col in required_columns:
-            if col not in df.columns:
-                return JSONResponse(content={"error": f"CSVに'{col}'列が存在しません。"}, status_code=400)
-
-        # グラフ保存関数
-        def save_plot(fig, title):
-            filename = f"{uuid.uuid4().hex}.png"
-            path = os.path.join(IMAGE_DIR, filename)
-            fig.savefig(path, bbox_inches='tight')
-            plt.close(fig)
-            return {
-                "title": title,
-                "url": f"https://graph-api2.onrender.com/images/{filename}"
-            }
+        # 末尾でマルチバイト文字が切れていても UTF-8 とみなす
+        sample.decode("utf-8")
+        return "utf-8"
+    except UnicodeDecodeError as e:
+        if e.start >= len(sample) - 3:
+            return "utf-8"
+    encoding = (chardet.detect(sample).get("encoding") or "utf-8").lower()
+    # Shift_JIS は機種依存文字を含む cp932 として読む
+    if encoding in ("shift_jis", "windows-31j"):
+        return "cp932"
+    return encoding
 
-        response = []
 
-        try:
-            fig = plt.figure()
-            sns.barplot(data=df, x="サブカテゴリ", y="売上金額", estimator=sum)
-            plt.xticks(rotation=45)
-            response.append(save_plot(fig, "サブカテゴリ別売上"))
-        except Exception as e:
-            print("Error in サブカテゴリ別売上:", e)
+def read_header(path, encoding):
+    """ヘッダ行だけを読んでカラム名を返す"""
+    return list(pd.read_csv(path, nrows=0, encoding=encoding).columns)
 
-        try:
-            fig = plt.figure()
-            sns.barplot(data=df, x="曜日", y="売上金額", estimator=sum)
-            response.append(save_plot(fig, "曜日別売上"))
-        except Exception as e:
-            print("Error in 曜日別売上:", e)
 
-        try:
-            fig = plt.figure()
-            sns.barplot(data=df, x="値引き率", y="売上金額")
-            response.append(save_plot(fig, "値引き率ごとの平均売上"))
-        except Exception as e:
-            print("Error in 値引き率ごとの平均売上:", e)
+def read_sales_chunks(path, encoding, columns=required_columns, chunksize=CSV_CHUNK_ROWS):
+    """必要なカラムだけを型指定でチャンクごとに読み込む"""
+    return pd.read_csv(
+        path,
+        encoding=encoding,
+        usecols=columns,
+        dtype=column_dtypes,
+        parse_dates=[date_column] if date_column in columns else None,
+        chunksize=chunksize,
+    )
 
-        try:
-            fig = plt.figure()
-            sns.barplot(data=df, x="廃棄率", y="売上金額")
-            response.append(save_plot(fig, "廃棄率ごとの平均売上"))
-        except Exception as e:
-            print("Error in 廃棄率ごとの平均売上:", e)
 
-        try:
-            fig = plt.figure()
-            sns.scatterplot(data=df, x="最高気温", y="売上金額")
-            response.append(save_plot(fig, "気温と売上の関係"))
-        except Exception as e:
-            print("Error in 気温と売上の関係:", e)
+def _finish_stats(t):
+    """sum/count/sumsq から mean と標本標準偏差を求める"""
+    out = pd.DataFrame(index=t.index)
+    out["sum"] = t["sum"]
+    out["mean"] = t["sum"] / t["count"]
+    var = (t["sumsq"] - t["count"] * out["mean"] ** 2) / (t["count"] - 1)
+    out["std"] = np.sqrt(var.clip(lower=0))
+    out["count"] = t["count"]
+    return out
+
+
+def _moments(sales, keys):
+    grouped = pd.DataFrame({"sum": sales, "sumsq": sales * sales}).groupby(keys, observed=True, sort=False)
+    t = grouped.sum()
+    t["count"] = grouped.size()
+    return t
+
+
+def _fold(total, part):
+    return part if total is None else total.add(part, fill_value=0)
+
+
+def _bottom_k(df, keys, k):
+    """ランダムキーの小さい順に各グループ k 行を残す（一様な非復元抽出）"""
+    df = df.sort_values("_key")
+    if keys:
+        return df.groupby(keys, observed=True, sort=False).head(k)
+    return df.head(k)
+
+
+class SalesAggregator:
+    """チャンクごとに集計を畳み込み、グラフ用の小さな表を作る"""
+
+    def __init__(self, sample_size=SCATTER_SAMPLE_SIZE, box_sample_size=BOX_SAMPLE_SIZE, seed=0):
+        self.rows = 0
+        self.sample_size = sample_size
+        self.box_sample_size = box_sample_size
+        self._rng = np.random.default_rng(seed)
+        self._weekdays = {}
+        self._subcategories = {}
+        self._cross = None
+        self._cross_range = None
+        self._discount = None
+        self._waste = None
+        self._products = None
+        self._box_sample = None
+        self._scatter = None
+
+    def update(self, df):
+        df = df[df["売上金額"].notna()]
+        if df.empty:
+            return
+        self.rows += len(df)
+        sales = df["売上金額"].astype("float64")
+        for v in df["曜日"].dropna().unique():
+            self._weekdays.setdefault(v, None)
+        for v in df["サブカテゴリ"].dropna().unique():
+            self._subcategories.setdefault(v, None)
+
+        # 曜日×サブカテゴリの集計から曜日別・サブカテゴリ別を導出する
+        cross_keys = [df["曜日"], df["サブカテゴリ"]]
+        self._cross = _fold(self._cross, _moments(sales, cross_keys))
+        part = sales.groupby(cross_keys, observed=True, sort=False).agg(["min", "max"])
+        if self._cross_range is not None:
+            part = pd.concat([self._cross_range, part]).groupby(level=[0, 1], sort=False).agg({"min": "min", "max": "max"})
+        self._cross_range = part
+
+        self._discount = _fold(self._discount, _moments(sales, df["値引き率"]))
+        self._waste = _fold(self._waste, _moments(sales, df["廃棄率"]))
+        self._products = _fold(self._products, sales.groupby(df["商品名"], observed=True, sort=False).sum())
+
+        keys = self._rng.random(len(df))
+        box_cols = ["曜日", "サブカテゴリ"]
+        part = _bottom_k(df[box_cols + ["売上金額"]].assign(_key=keys), box_cols, self.box_sample_size)
+        part = part.astype({"曜日": object, "サブカテゴリ": object})
+        if self._box_sample is not None:
+            part = _bottom_k(pd.concat([self._box_sample, part]), box_cols, self.box_sample_size)
+        self._box_sample = part
+
+        part = df[["最高気温", "売上金額", "サブカテゴリ"]].assign(_key=keys).nsmallest(self.sample_size, "_key")
+        part = part.astype({"サブカテゴリ": object})
+        if self._scatter is not None:
+            part = pd.concat([self._scatter, part]).nsmallest(self.sample_size, "_key")
+        self._scatter = part
+
+    def _box_whiskers(self, box):
+        """ひげは 1.5×IQR の内側にある最も外側の値、外れ値はその外側の値とする。
+        最小・最大は全行から正確に求め、それ以外はサンプルから求める"""
+        iqr = box["q3"] - box["q1"]
+        fences = pd.DataFrame({"lo": box["q1"] - 1.5 * iqr, "hi": box["q3"] + 1.5 * iqr})
+        sample = self._box_sample.join(fences, on=["曜日", "サブカテゴリ"])
+        sales = sample["売上金額"]
+        inside = sales.between(sample["lo"], sample["hi"])
+        within = sales[inside].groupby([sample["曜日"], sample["サブカテゴリ"]], sort=False).agg(["min", "max"])
+        within = within.reindex(box.index)
+        # 最小・最大がフェンスの内側なら、それがそのままひげの端になる
+        box["whislo"] = box["min"].where(box["min"] >= fences["lo"], within["min"])
+        box["whishi"] = box["max"].where(box["max"] <= fences["hi"], within["max"])
+        outliers = sales[~inside].groupby([sample["曜日"], sample["サブカテゴリ"]], sort=False).agg(list)
+        fliers = []
+        for key, r in box.iterrows():
+            values = set(outliers.get(key, []))
+            values.update(v for v in (r["min"], r["max"]) if not fences["lo"][key] <= v <= fences["hi"][key])
+            fliers.append(sorted(values))
+        box["fliers"] = fliers
+
+    def result(self):
+        if self.rows == 0:
+            raise EmptyDatasetError("集計できる行がありません。")
+        weekdays = list(self._weekdays)
+        subcategories = list(self._subcategories)
+
+        def rollup(level, order):
+            t = self._cross.groupby(level=level, sort=False).sum()
+            return _finish_stats(t.reindex([v for v in order if v in t.index]))
+
+        box = self._box_sample.groupby(["曜日", "サブカテゴリ"], sort=False)["売上金額"].quantile([0.25, 0.5, 0.75]).unstack()
+        box.columns = ["q1", "med", "q3"]
+        box = box.join(self._cross_range)
+        box = box.reindex([(d, s) for d in weekdays for s in subcategories if (d, s) in box.index])
+        self._box_whiskers(box)
+
+        return {
+            "subcategory": rollup("サブカテゴリ", subcategories),
+            "weekday": rollup("曜日", weekdays),
+            "discount": _finish_stats(self._discount.sort_index()),
+            "waste": _finish_stats(self._waste.sort_index()),
+            "top10": self._products.nlargest(10),
+            "box": box,
+            "scatter": self._scatter.drop(columns="_key").sort_index(),
+        }
+
+
+def aggregate_sales(df, sample_size=SCATTER_SAMPLE_SIZE):
+    """メモリ上の DataFrame から全グラフで使う集計を計算する"""
+    aggregator = SalesAggregator(sample_size=sample_size)
+    aggregator.update(df)
+    return aggregator.result()
+
+
+def _bar(ax, table, stat):
+    x = [str(v) for v in table.index]
+    sns.barplot(x=x, y=table[stat].values, order=x, errorbar=None, ax=ax)
+    if CHART_ERRORBARS:
+        sem = table["std"] / np.sqrt(table["count"])
+        err = 1.96 * sem * (table["count"] if stat == "sum" else 1)
+        ax.errorbar(range(len(x)), table[stat].values, yerr=err.fillna(0).values, fmt="none", color="black")
+
+
+def plot_subcategory_sales(ax, agg):
+    _bar(ax, agg["subcategory"], "sum")
+    ax.tick_params(axis="x", rotation=45)
+
+
+def plot_weekday_sales(ax, agg):
+    _bar(ax, agg["weekday"], "sum")
+
+
+def plot_discount_sales(ax, agg):
+    _bar(ax, agg["discount"], "mean")
+
+
+def plot_waste_sales(ax, agg):
+    _bar(ax, agg["waste"], "mean")
+
+
+def plot_temperature_scatter(ax, agg):
+    sns.scatterplot(data=agg["scatter"], x="最高気温", y="売上金額", ax=ax)
+
+
+def plot_top10(ax, agg):
+    top10 = agg["top10"]
+    sns.barplot(x=top10.values, y=[str(v) for v in top10.index], ax=ax)
+
+
+def plot_temperature_subcategory_scatter(ax, agg):
+    sns.scatterplot(data=agg["scatter"], x="最高気温", y="売上金額", hue="サブカテゴリ", ax=ax)
+
+
+def plot_weekday_subcategory_box(ax, agg):
+    box = agg["box"]
+    weekdays = list(dict.fromkeys(box.index.get_level_values(0)))
+    subcats = list(dict.fromkeys(box.index.get_level_values(1)))
+    palette = sns.color_palette(n_colors=len(subcats))
+    width = 0.8 / max(len(subcats), 1)
+    for j, sub in enumerate(subcats):
+        stats, positions = [], []
+        for i, day in enumerate(weekdays):
+            if (day, sub) not in box.index:
+                continue
+            r = box.loc[(day, sub)]
+            stats.append({
+                "med": r["med"], "q1": r["q1"], "q3": r["q3"],
+                "whislo": r["whislo"], "whishi": r["whishi"], "fliers": r["fliers"],
+            })
+            positions.append(i - 0.4 + width * (j + 0.5))
+        if stats:
+            ax.bxp(stats, positions=positions, widths=width * 0.9, patch_artist=True,
+                   boxprops={"facecolor": palette[j]}, medianprops={"color": "black"},
+                   flierprops={"markersize": 3},
+                   manage_ticks=False, label=str(sub))
+    ax.set_xticks(range(len(weekdays)), [str(d) for d in weekdays])
+    ax.set_xlabel("曜日")
+    ax.set_ylabel("売上金額")
+    if subcats:
+        ax.legend(title="サブカテゴリ")
+
+
+def _pie(ax, series):
+    ax.pie(series.values, labels=[str(v) for v in series.index], autopct='%1.1f%%')
+    ax.axis("equal")
+
+
+def plot_subcategory_pie(ax, agg):
+    _pie(ax, agg["subcategory"]["sum"].sort_index())
+
+
+def plot_weekday_pie(ax, agg):
+    _pie(ax, agg["weekday"]["sum"].sort_index())
 
+
+# (タイトル, 描画関数, 描画に必要な集計)
+CHARTS = [
+    ("サブカテゴリ別売上", plot_subcategory_sales, ["subcategory"]),
+    ("曜日別売上", plot_weekday_sales, ["weekday"]),
+    ("値引き率ごとの平均売上", plot_discount_sales, ["discount"]),
+    ("廃棄率ごとの平均売上", plot_waste_sales, ["waste"]),
+    ("気温と売上の関係", plot_temperature_scatter, ["scatter"]),
+    ("売上金額トップ10商品", plot_top10, ["top10"]),
+    ("気温とサブカテゴリ別売上", plot_temperature_subcategory_scatter, ["scatter"]),
+    ("曜日とサブカテゴリの売上傾向", plot_weekday_subcategory_box, ["box"]),
+    ("サブカテゴリ別売上構成", plot_subcategory_pie, ["subcategory"]),
+    ("曜日別売上構成", plot_weekday_pie, ["weekday"]),
+]
+
+
+def render_options():
+    """描画プロセスへ渡す描画設定"""
+    return {
+        "mode": RENDER_MODE,
+        "format": IMAGE_FORMAT,
+        "dpi": IMAGE_DPI,
+        "png_compression": PNG_COMPRESSION,
+        "webp_quality": WEBP_QUALITY,
+    }
+
+
+def _save_kwargs(options):
+    kwargs = {"format": options["format"], "dpi": options["dpi"]}
+    if options["format"] == "png":
+        kwargs["pil_kwargs"] = {"compress_level": options["png_compression"]}
+    elif options["format"] == "webp":
+        kwargs["pil_kwargs"] = {"quality": options["webp_quality"]}
+    return kwargs
+
+
+# fast モードで使い回す Figure（グラフごと）。描画プロセスは1件ずつ順に描くので、
+# 使い回すのは描画プロセスの中だけにする（リクエストのスレッドごとに持つと数百枚が残り続ける）
+_templates = {}
+_reuse_figures = False
+
+
+def _fast_figure(dpi):
+    fig = Figure(dpi=dpi)
+    fig.subplots_adjust(left=0.16, right=0.96, bottom=0.18, top=0.95)
+    return fig, fig.subplots()
+
+
+def _template(name, dpi):
+    """使い回す Figure を取り出し、前回描いた内容を消して返す"""
+    if not _reuse_figures:
+        return _fast_figure(dpi)
+    if (name, dpi) not in _templates:
+        _templates[(name, dpi)] = _fast_figure(dpi)
+    fig, ax = _templates[(name, dpi)]
+    # 位置やサイズはそのままに、データ・目盛り・色の順番だけを初期状態へ戻す
+    ax.clear()
+    return fig, ax
+
+
+_text_to_path = TextToPath()
+
+
+@functools.lru_cache(maxsize=4096)
+def _text_width_pt(text, prop):
+    return _text_to_path.get_text_width_height_descent(text, prop, ismath=False)[0]
+
+
+def _text_size(label, dpi):
+    """図全体を描画せずに、フォントの字幅から文字列の (幅, 高さ) をピクセルで求める"""
+    scale = dpi / 72
+    return _text_width_pt(label.get_text(), label.get_fontproperties()) * scale, label.get_fontsize() * scale
+
+
+def _fit_margins(fig, ax):
+    """目盛りラベルの長さから左・下の余白を決める（fast モード用）。
+    bbox_inches='tight' と違って描画し直さないので、グラフごとのラベルに合わせても速いまま"""
+    width, height = fig.get_size_inches() * fig.dpi
+    pad = 8 * fig.dpi / 72
+
+    def extent(ticklabels, axis_label, vertical):
+        size = 0.0
+        for label in ticklabels:
+            w, h = _text_size(label, fig.dpi)
+            r = np.radians(label.get_rotation())
+            sin, cos = abs(np.sin(r)), abs(np.cos(r))
+            size = max(size, w * sin + h * cos if vertical else w * cos + h * sin)
+        if axis_label.get_text():
+            size += pad + _text_size(axis_label, fig.dpi)[1]
+        return size + 2 * pad
+
+    left = extent(ax.get_yticklabels(), ax.yaxis.label, vertical=False) / width
+    bottom = extent(ax.get_xticklabels(), ax.xaxis.label, vertical=True)
+    if isinstance(ax.xaxis.get_major_formatter(), ScalarFormatter):
+        # 「1e7」などの指数表示が目盛りの下に出ることがある
+        bottom += _text_size(ax.xaxis.get_offset_text(), fig.dpi)[1]
+    bottom /= height
+    fig.subplots_adjust(left=min(max(left, 0.05), 0.6), bottom=min(max(bottom, 0.05), 0.5))
+
+
+def render_chart(draw, data, path, options=None):
+    """Figure を直接使って1枚描画・保存し、描画・書き込みの時間（ms）とバイト数を返す"""
+    options = options or render_options()
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    if options["mode"] == "fast":
+        fig, ax = _template(draw.__name__, options["dpi"])
+        draw(ax, data)
+        _fit_margins(fig, ax)
+        fig.savefig(buffer, **_save_kwargs(options))
+    else:
+        fig = Figure()
+        ax = fig.subplots()
+        draw(ax, data)
+        fig.savefig(buffer, bbox_inches='tight', **_save_kwargs(options))
+    rendered = time.perf_counter()
+    # 書きかけのファイルを配信しないよう、書き終えてから置き換える
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(buffer.getbuffer())
+    os.replace(f"{path}.tmp", path)
+    return {
+        "render_ms": (rendered - start) * 1000,
+        "write_ms": (time.perf_counter() - rendered) * 1000,
+        "bytes": buffer.getbuffer().nbytes,
+    }
+
+
+def _warm_render_worker():
+    """フォントキャッシュを作るため日本語を含む小さな図を一度描いておく"""
+    global _reuse_figures
+    _reuse_figures = True
+    fig = Figure(figsize=(1, 1))
+    fig.text(0.5, 0.5, "売上")
+    fig.canvas.draw()
+
+
+render_pool = None
+
+
+def start_render_pool(workers=RENDER_WORKERS):
+    """描画プロセスを起動し、全プロセスの初期化を済ませておく"""
+    global render_pool
+    if workers <= 0 or render_pool is not None:
+        return
+    render_pool = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_warm_render_worker,
+    )
+    # submit するたびにプロセスが起動するので、プロセス数だけ空の仕事を投げて待つ
+    for future in [render_pool.submit(time.sleep, 0.1) for _ in range(workers)]:
+        future.result()
+
+
+def stop_render_pool():
+    global render_pool
+    if render_pool is not None:
+        render_pool.shutdown()
+        render_pool = None
+
+
+def render_charts(agg, paths, charts=CHARTS):
+    """各グラフに必要な集計だけを渡して描画し、(番号, タイトル, 計測結果 or 例外) を完了順に返す"""
+    options = render_options()
+    if render_pool is None:
+        for index, ((title, draw, keys), path) in enumerate(zip(charts, paths)):
+            try:
+                yield index, title, render_chart(draw, {key: agg[key] for key in keys}, path, options)
+            except Exception as e:
+                yield index, title, e
+        return
+
+    futures = {}
+    for index, ((title, draw, keys), path) in enumerate(zip(charts, paths)):
+        data = {key: agg[key] for key in keys}
+        futures[render_pool.submit(render_chart, draw, data, path, options)] = (index, title)
+    for future in as_completed(futures):
+        index, title = futures[future]
         try:
-            fig = plt.figure()
-            top10 = df.groupby("商品名")["売上金額"].sum().sort_values(ascending=False).head(10)
-            sns.barplot(x=top10.values, y=top10.index)
-            response.append(save_plot(fig, "売上金額トップ10商品"))
+            yield index, title, future.result()
         except Exception as e:
-            print("Error in 売上金額トップ10商品:", e)
+            yield index, title, e
+
+
+def chart_config_key():
+    """グラフの出力に影響する設定をまとめたハッシュ"""
+    config = {
+        "charts": [chart[0] for chart in CHARTS],
+        "errorbars": CHART_ERRORBARS,
+        "scatter_sample_size": SCATTER_SAMPLE_SIZE,
+        "box_sample_size": BOX_SAMPLE_SIZE,
+        "render": render_options(),
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def result_cache_key(dataset_id, filters=None):
+    """データセット・絞り込み条件・グラフ設定から結果キャッシュのキーを作る"""
+    key = f"{dataset_id}:{chart_config_key()}"
+    if filters:
+        key += ":" + hashlib.sha256(json.dumps(filters, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+    return key
+
+
+class ResultCache:
+    """アップロード内容のハッシュをキーに生成済みの画像URLを保持する"""
+
+    def __init__(self, max_entries=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL, image_dir=IMAGE_DIR):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.image_dir = image_dir
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            self._evict_expired()
+            entry = self._entries.get(key)
+            if entry is not None and not all(
+                os.path.exists(os.path.join(self.image_dir, name)) for name in entry["filenames"]
+            ):
+                # 画像が消えていたら作り直す
+                self._evict(key)
+                entry = None
+            self._record(entry is not None)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return [dict(item) for item in entry["response"]]
+
+    def record(self, hit):
+        """エントリを持たない参照（lazy モードのURL一覧など）のヒット・ミスを数える"""
+        with self._lock:
+            self._record(hit)
+
+    def _record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        cache_requests.inc(result="hit" if hit else "miss")
+
+    def put(self, key, response, filenames):
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+            self._entries[key] = {
+                "created_at": time.time(),
+                "response": [dict(item) for item in response],
+                "filenames": list(filenames),
+            }
+            while len(self._entries) > self.max_entries:
+                self._evict(next(iter(self._entries)))
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+    def _evict_expired(self):
+        now = time.time()
+        for key in [k for k, e in self._entries.items() if now - e["created_at"] > self.ttl]:
+            self._evict(key)
+
+    def _evict(self, key):
+        entry = self._entries.pop(key)
+        self.evictions += 1
+        for name in entry["filenames"]:
+            try:
+                os.remove(os.path.join(self.image_dir, name))
+            except FileNotFoundError:
+                pass
+
+
+result_cache = ResultCache()
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    return result_cache.stats()
+
+
+def _frame_bytes(obj):
+    return int(np.sum(obj.memory_usage(deep=True)))
+
+
+class DatasetStore:
+    """アップロードごとの集計前データ（読み込んだチャンクのまま）と集計結果を保持する（LRU・メモリ上限・TTL付き）"""
+
+    def __init__(self, max_bytes=DATASET_STORE_BYTES, ttl=DATASET_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, dataset_id):
+        """集計前データのチャンクの一覧を返す（上限を超えて保持していなければ None）"""
+        entry = self._get(dataset_id)
+        return None if entry is None else entry["chunks"]
+
+    def get_aggregates(self, dataset_id):
+        """グラフ描画用の集計結果を返す"""
+        entry = self._get(dataset_id)
+        return None if entry is None else entry["agg"]
+
+    def get_rows(self, dataset_id):
+        """集計した行数を返す"""
+        entry = self._get(dataset_id)
+        return None if entry is None else entry["rows"]
+
+    def put(self, dataset_id, chunks=None, agg=None, rows=0):
+        agg_bytes = sum(_frame_bytes(table) for table in agg.values()) if agg else 0
+        raw_bytes = sum(_frame_bytes(chunk) for chunk in chunks) if chunks else 0
+        # 集計前データが上限を超えるときは集計結果だけを保持する
+        if raw_bytes + agg_bytes > self.max_bytes:
+            chunks, raw_bytes = None, 0
+        nbytes = raw_bytes + agg_bytes
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if dataset_id in self._entries:
+                self._evict(dataset_id)
+            self._entries[dataset_id] = {
+                "chunks": chunks, "agg": agg, "rows": rows, "nbytes": nbytes, "last_access": time.time(),
+            }
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self._evict(next(iter(self._entries)))
+
+    def stats(self):
+        with self._lock:
+            return {"datasets": len(self._entries), "bytes": self.nbytes, "max_bytes": self.max_bytes}
+
+    def _get(self, dataset_id):
+        with self._lock:
+            self._evict_expired()
+            entry = self._entries.get(dataset_id)
+            if entry is None:
+                return None
+            entry["last_access"] = time.time()
+            self._entries.move_to_end(dataset_id)
+            return entry
 
+    def _evict_expired(self):
+        now = time.time()
+        for key in [k for k, e in self._entries.items() if now - e["last_access"] > self.ttl]:
+            self._evict(key)
+
+    def _evict(self, dataset_id):
+        self.nbytes -= self._entries.pop(dataset_id)["nbytes"]
+
+
+dataset_store = DatasetStore()
+
+
+# データセットIDは内容の SHA-256（絞り込み結果は元のIDと条件の SHA-256）
+DATASET_ID_PATTERN = r"[0-9a-f]{64}"
+
+
+def filtered_dataset_id(dataset_id, subcategory, start, end):
+    filters = {"subcategory": subcategory, "start": start, "end": end}
+    return hashlib.sha256(f"{dataset_id}:{json.dumps(filters, sort_keys=True, ensure_ascii=False)}".encode()).hexdigest()
+
+
+def aggregates_path(dataset_id):
+    return os.path.join(DATASET_DIR, f"{dataset_id}.pkl")
+
+
+def save_aggregates(dataset_id, agg, rows, filterable=False):
+    """集計結果をディスクにも保存する（メモリ上のデータセットは TTL・LRU で消えるため）。
+    filterable は集計前データも保持できる大きさだったか"""
+    path = aggregates_path(dataset_id)
+    with open(f"{path}.tmp", "wb") as f:
+        pickle.dump({"agg": agg, "rows": rows, "filterable": filterable}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{path}.tmp", path)
+
+
+def has_aggregates(dataset_id):
+    if not re.fullmatch(DATASET_ID_PATTERN, dataset_id):
+        return False
+    return dataset_store.get_aggregates(dataset_id) is not None or os.path.exists(aggregates_path(dataset_id))
+
+
+def load_aggregates(dataset_id):
+    """集計結果を返す。メモリになければディスクから読み込んで保持し直す（どちらにもなければ None）"""
+    if not re.fullmatch(DATASET_ID_PATTERN, dataset_id):
+        return None
+    agg = dataset_store.get_aggregates(dataset_id)
+    if agg is not None:
+        return agg
+    saved = _read_aggregates(dataset_id)
+    if saved is None:
+        return None
+    dataset_store.put(dataset_id, None, saved["agg"], saved["rows"])
+    return saved["agg"]
+
+
+def _read_aggregates(dataset_id):
+    path = aggregates_path(dataset_id)
+    try:
+        with open(path, "rb") as f:
+            saved = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    # 最後に使われた時刻として容量超過時の削除順に使う
+    os.utime(path)
+    return saved
+
+
+def lost_raw_data(dataset_id):
+    """集計前データを保持できる大きさだったのに、メモリから消えているか（再アップロードで読み込み直す）"""
+    if dataset_store.get(dataset_id) is not None:
+        return False
+    saved = _read_aggregates(dataset_id)
+    return saved is not None and saved["filterable"]
+
+
+class MissingColumnError(ValueError):
+    pass
+
+
+class EmptyDatasetError(ValueError):
+    """ヘッダだけのCSVや売上金額が空のCSVなど、集計できる行がない"""
+
+
+def prepare_upload(file):
+    """アップロードを保存し、(CSVのパス, データセットID) を返す。IDは内容の SHA-256。
+    同じファイル名の同時アップロードで上書きされないよう、保存先はリクエストごとに別の名前にする"""
+    csv_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}.csv")
+    try:
+        with stage_seconds.time(stage="save"):
+            dataset_id = save_upload(file.file, csv_path)
+    except Exception:
+        discard_upload(csv_path)
+        raise
+    upload_bytes.inc(os.path.getsize(csv_path))
+    return csv_path, dataset_id
+
+
+def discard_upload(csv_path):
+    """集計を終えたアップロードを削除する"""
+    try:
+        os.remove(csv_path)
+    except FileNotFoundError:
+        pass
+
+
+def check_columns(csv_path):
+    """必須カラムを確認し、(CSVの文字コード, 読み込むカラム) を返す"""
+    encoding = detect_encoding(csv_path)
+    header = read_header(csv_path, encoding)
+    missing = [col for col in required_columns if col not in header]
+    if missing:
+        raise MissingColumnError(f"CSVに'{missing[0]}'列が存在しません。")
+    columns = required_columns + ([date_column] if date_column in header else [])
+    return encoding, columns
+
+
+def _record_chart(title, result):
+    """1枚分の描画結果をメトリクスに記録する"""
+    if isinstance(result, Exception):
+        print(f"Error in {title}:", result)
+        chart_errors.inc(chart=title)
+        return
+    chart_seconds.observe(result["render_ms"] / 1000, chart=title, step="render")
+    chart_seconds.observe(result["write_ms"] / 1000, chart=title, step="write")
+    images_written.inc(chart=title)
+    image_bytes.inc(result["bytes"], chart=title)
+
+
+def draw_charts(agg, charts=CHARTS, on_chart=None):
+    """集計済みデータからグラフを描画し、(レスポンス, 画像ファイル名) を返す"""
+    filenames = [f"{uuid.uuid4().hex}.{IMAGE_FORMAT}" for _ in charts]
+    paths = [os.path.join(IMAGE_DIR, filename) for filename in filenames]
+
+    results = {}
+
+    for index, title, result in render_charts(agg, paths, charts):
+        _record_chart(title, result)
+        if isinstance(result, Exception):
+            continue
+        item = {
+            "title": title,
+            "url": f"{PUBLIC_BASE_URL}/images/{filenames[index]}",
+            "elapsed_ms": round(result["render_ms"] + result["write_ms"], 1),
+            "render_ms": round(result["render_ms"], 1),
+            "write_ms": round(result["write_ms"], 1),
+            "bytes": result["bytes"],
+        }
+        results[index] = item
+        if on_chart is not None:
+            on_chart(item)
+
+    return [results[index] for index in sorted(results)], filenames
+
+
+def chart_slug(chart):
+    """URLに使うグラフの種類名（描画関数名から plot_ を除いたもの）"""
+    return chart[1].__name__.removeprefix("plot_")
+
+
+CHARTS_BY_SLUG = {chart_slug(chart): chart for chart in CHARTS}
+
+
+def chart_links(dataset_id, charts=CHARTS):
+    """データセットIDとグラフの種類から決まるURLの一覧"""
+    return [
+        {"title": chart[0], "url": f"{PUBLIC_BASE_URL}/charts/{dataset_id}/{chart_slug(chart)}.{IMAGE_FORMAT}"}
+        for chart in charts
+    ]
+
+
+def chart_path(dataset_id, slug):
+    # 描画設定が変わったら別のファイルになるよう設定のハッシュを含める
+    return os.path.join(IMAGE_DIR, f"{dataset_id}-{chart_config_key()[:12]}-{slug}.{IMAGE_FORMAT}")
+
+
+def cached_charts(dataset_id):
+    """同じ内容・同じ設定で処理済みならレスポンスを返す"""
+    if CHART_RENDERING == "lazy":
+        # 集計結果が残っていればURLはそのまま使える。絞り込み用の集計前データが消えていれば読み込み直す
+        hit = has_aggregates(dataset_id) and not lost_raw_data(dataset_id)
+        result_cache.record(hit)
+        return chart_links(dataset_id) if hit else None
+    return result_cache.get(result_cache_key(dataset_id))
+
+
+def ingest_csv(csv_path, encoding, columns, dataset_id, timings):
+    """CSVを読み込んで集計し、データセットとして保持する"""
+    timings.update(parse_ms=0.0, aggregate_ms=0.0)
+    # CSV読み込みと集計（全グラフ共通）。1件あたりの上限に収まる間は集計前データもチャンクのまま保持する
+    aggregator = SalesAggregator()
+    chunks, nbytes = [], 0
+    with read_sales_chunks(csv_path, encoding, columns) as reader:
+        parse_start = time.perf_counter()
+        for chunk in reader:
+            aggregate_start = time.perf_counter()
+            timings["parse_ms"] += (aggregate_start - parse_start) * 1000
+            aggregator.update(chunk)
+            parse_start = time.perf_counter()
+            timings["aggregate_ms"] += (parse_start - aggregate_start) * 1000
+            if chunks is not None:
+                nbytes += int(chunk.memory_usage(deep=True).sum())
+                if nbytes <= DATASET_UPLOAD_BYTES:
+                    chunks.append(chunk)
+                else:
+                    chunks = None
+    agg = aggregator.result()
+    dataset_store.put(dataset_id, chunks or None, agg, aggregator.rows)
+    save_aggregates(dataset_id, agg, aggregator.rows, filterable=bool(chunks))
+    timings["rows"] = aggregator.rows
+    rows_processed.inc(aggregator.rows)
+    stage_seconds.observe(timings["parse_ms"] / 1000, stage="parse")
+    stage_seconds.observe(timings["aggregate_ms"] / 1000, stage="aggregate")
+    return agg
+
+
+def generate_charts(csv_path, encoding, columns, dataset_id, on_chart=None, timings=None):
+    """CSVを集計し、グラフのURL一覧を返す。eager なら全グラフをここで描画する。
+    on_chart には描画が終わった順に各グラフが渡される。
+    timings を渡すと読み込み・集計・描画の時間（ms）を書き込む"""
+    timings = {} if timings is None else timings
+    agg = ingest_csv(csv_path, encoding, columns, dataset_id, timings)
+
+    if CHART_RENDERING == "lazy":
+        timings["render_ms"] = 0.0
+        response = chart_links(dataset_id)
+        if on_chart is not None:
+            for item in response:
+                on_chart(item)
+        return response
+
+    start = time.perf_counter()
+    response, filenames = draw_charts(agg, on_chart=on_chart)
+    timings["render_ms"] = (time.perf_counter() - start) * 1000
+    stage_seconds.observe(timings["render_ms"] / 1000, stage="render")
+    # 一部のグラフが失敗した結果はキャッシュしない
+    if len(response) == len(CHARTS):
+        result_cache.put(result_cache_key(dataset_id), response, filenames)
+    return response
+
+
+def _upload_and_generate(file):
+    """アップロードからグラフ生成までを行い、(内容, ステータスコード, ヘッダ) を返す"""
+    csv_path = None
+    try:
+        # ファイル保存（チャンク単位で書き出す）
+        csv_path, dataset_id = prepare_upload(file)
+        headers = {"X-Dataset-Id": dataset_id}
+
+        # 同じ内容・同じ設定なら処理済みの結果を返す
+        cached = cached_charts(dataset_id)
+        if cached is not None:
+            return cached, 200, headers
+
+        # 必須カラムチェック（ヘッダのみ）
+        encoding, columns = check_columns(csv_path)
+
+        timings = {}
+        response = generate_charts(csv_path, encoding, columns, dataset_id, timings=timings)
+        headers["Server-Timing"] = ", ".join(
+            f"{name};dur={timings[f'{name}_ms']:.1f}" for name in ("parse", "aggregate", "render")
+        )
+        return response, 200, headers
+
+    except (MissingColumnError, EmptyDatasetError) as e:
+        request_errors.inc(endpoint="upload-and-generate", status="400")
+        return {"error": str(e)}, 400, None
+    except Exception as e:
+        request_errors.inc(endpoint="upload-and-generate", status="500")
+        return {"error": str(e)}, 500, None
+    finally:
+        if csv_path is not None:
+            discard_upload(csv_path)
+
+
+_profile_lock = threading.Lock()
+
+
+@app.post("/upload-and-generate")
+def upload_and_generate(file: UploadFile = File(...), profile: bool = False):
+    if not profile:
+        content, status_code, headers = _upload_and_generate(file)
+        return JSONResponse(content=content, status_code=status_code, headers=headers)
+
+    # Python 3.12 以降の cProfile はプロセス全体で1つしか有効にできないので、同時には1件だけ受け付ける
+    if not _profile_lock.acquire(blocking=False):
+        request_errors.inc(endpoint="upload-and-generate", status="429")
+        return JSONResponse(content={"error": "別のプロファイル中のリクエストを処理しています。時間をおいて再度お試しください。"}, status_code=429)
+    # 描画プロセス内の処理は含まれない（リクエストを処理したプロセスのみ）。
+    # 同時に処理している他のリクエストのスレッドも含まれることがある
+    profiler = cProfile.Profile()
+    try:
         try:
-            fig = plt.figure()
-            sns.scatterplot(data=df, x="最高気温", y="売上金額", hue="サブカテゴリ")
-            response.append(save_plot(fig, "気温とサブカテゴリ別売上"))
-        except Exception as e:
-            print("Error in 気温とサブカテゴリ別売上:", e)
+            profiler.enable()
+        except ValueError as e:
+            # 他のプロファイラが動いている
+            request_errors.inc(endpoint="upload-and-generate", status="409")
+            return JSONResponse(content={"error": str(e)}, status_code=409)
+        try:
+            content, status_code, headers = _upload_and_generate(file)
+        finally:
+            profiler.disable()
+    finally:
+        _profile_lock.release()
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+    if status_code == 200:
+        content = {"charts": content}
+    content["profile"] = summary.getvalue()
+    return JSONResponse(content=content, status_code=status_code, headers=headers)
+
+
+_render_locks = {}
+_render_locks_lock = threading.Lock()
+
 
+@app.get("/charts/{dataset_id}/{filename}")
+def get_chart(dataset_id: str, filename: str, request: Request):
+    slug, _, ext = filename.rpartition(".")
+    chart = CHARTS_BY_SLUG.get(slug)
+    if not re.fullmatch(DATASET_ID_PATTERN, dataset_id) or chart is None or ext != IMAGE_FORMAT:
+        return JSONResponse(content={"error": "グラフが見つかりません。"}, status_code=404)
+
+    etag = '"' + hashlib.sha256(f"{dataset_id}:{chart_config_key()}:{slug}".encode()).hexdigest()[:32] + '"'
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={CHART_MAX_AGE}"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    path = chart_path(dataset_id, slug)
+    if os.path.exists(path):
+        # 最後に使われた時刻として容量超過時の削除順に使う
+        os.utime(path)
+    else:
+        # 同じグラフへの同時リクエストでは1回だけ描画する
+        with _render_locks_lock:
+            lock = _render_locks.setdefault(path, threading.Lock())
         try:
-            fig = plt.figure()
-            sns.boxplot(data=df, x="曜日", y="売上金額", hue="サブカテゴリ")
-            response.append(save_plot(fig, "曜日とサブカテゴリの売上傾向"))
-        except Exception as e:
-            print("Error in 曜日とサブカテゴリの売上傾向:", e)
+            with lock:
+                if not os.path.exists(path):
+                    agg = load_aggregates(dataset_id)
+                    if agg is None:
+                        return JSONResponse(content={"error": "データセットが見つかりません。CSVを再アップロードしてください。"}, status_code=404)
+                    with stage_seconds.time(stage="render"):
+                        _, title, result = next(render_charts(agg, [path], [chart]))
+                    _record_chart(title, result)
+                    if isinstance(result, Exception):
+                        request_errors.inc(endpoint="charts", status="500")
+                        return JSONResponse(content={"error": str(result)}, status_code=500)
+        finally:
+            with _render_locks_lock:
+                _render_locks.pop(path, None)
+
+    media_types = {"png": "image/png", "webp": "image/webp", "svg": "image/svg+xml"}
+    return FileResponse(path, media_type=media_types.get(ext), headers=headers)
 
+
+def sweep_images(quota=IMAGE_DIR_QUOTA_BYTES, directory=IMAGE_DIR):
+    """ディレクトリが容量上限を超えていたら、最後に使われたのが古いファイルから削除する"""
+    files = []
+    for entry in os.scandir(directory):
+        if entry.is_file() and not entry.name.startswith(".") and not entry.name.endswith(".tmp"):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    for _, size, path in sorted(files):
+        if total <= quota:
+            break
         try:
-            fig = plt.figure()
-            pie_data = df.groupby("サブカテゴリ")["売上金額"].sum()
-            plt.pie(pie_data.values, labels=pie_data.index, autopct='%1.1f%%')
-            plt.axis("equal")
-            response.append(save_plot(fig, "サブカテゴリ別売上構成"))
-        except Exception as e:
-            print("Error in サブカテゴリ別売上構成:", e)
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    return removed
+
+
+_sweeper_stop = threading.Event()
+_sweeper_thread = None
 
+
+def _sweep_loop():
+    while not _sweeper_stop.wait(IMAGE_SWEEP_INTERVAL):
         try:
-            fig = plt.figure()
-            pie_data = df.groupby("曜日")["売上金額"].sum()
-            plt.pie(pie_data.values, labels=pie_data.index, autopct='%1.1f%%')
-            plt.axis("equal")
-            response.append(save_plot(fig, "曜日別売上構成"))
+            removed = sweep_images()
+            images_evicted.inc(removed)
+            if removed:
+                print(f"🧹 画像を{removed}件削除しました")
+            removed = sweep_images(DATASET_DIR_QUOTA_BYTES, DATASET_DIR)
+            datasets_evicted.inc(removed)
+            if removed:
+                print(f"🧹 集計結果を{removed}件削除しました")
         except Exception as e:
-            print("Error in 曜日別売上構成:", e)
+            print("Error in sweep_images:", e)
+
+
+def start_image_sweeper():
+    global _sweeper_thread
+    if _sweeper_thread is not None:
+        return
+    _sweeper_stop.clear()
+    _sweeper_thread = threading.Thread(target=_sweep_loop, name="image-sweeper", daemon=True)
+    _sweeper_thread.start()
+
+
+def stop_image_sweeper():
+    global _sweeper_thread
+    if _sweeper_thread is not None:
+        _sweeper_stop.set()
+        _sweeper_thread.join()
+        _sweeper_thread = None
+
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/datasets/{dataset_id}")
+def get_dataset(dataset_id: str):
+    agg = load_aggregates(dataset_id)
+    if agg is None:
+        return JSONResponse(content={"error": "データセットが見つかりません。CSVを再アップロードしてください。"}, status_code=404)
+    chunks = dataset_store.get(dataset_id)
+    info = {
+        "dataset_id": dataset_id,
+        "rows": dataset_store.get_rows(dataset_id),
+        "bytes": sum(_frame_bytes(chunk) for chunk in chunks) if chunks else 0,
+        # 集計前データを保持していなければ、絞り込みなしのグラフだけを作れる
+        "filterable": chunks is not None,
+        "subcategories": [str(v) for v in agg["subcategory"].index],
+        "charts": [chart[0] for chart in CHARTS],
+    }
+    if chunks and date_column in chunks[0].columns:
+        info["date_range"] = [
+            str(min(chunk[date_column].min() for chunk in chunks).date()),
+            str(max(chunk[date_column].max() for chunk in chunks).date()),
+        ]
+    return info
+
+
+@app.post("/datasets/{dataset_id}/charts")
+def generate_dataset_charts(
+    dataset_id: str,
+    subcategory: str | None = None,
+    start: str | None = None,
+    end: str | None = None,
+    chart: list[str] | None = Query(None),
+):
+    try:
+        agg = load_aggregates(dataset_id)
+        if agg is None:
+            return JSONResponse(content={"error": "データセットが見つかりません。CSVを再アップロードしてください。"}, status_code=404)
+        chunks = dataset_store.get(dataset_id)
+        filtered = subcategory is not None or start is not None or end is not None
+
+        charts = CHARTS
+        if chart:
+            unknown = [title for title in chart if title not in {c[0] for c in CHARTS}]
+            if unknown:
+                return JSONResponse(content={"error": f"'{unknown[0]}'というグラフはありません。"}, status_code=400)
+            charts = [c for c in CHARTS if c[0] in chart]
+
+        # 日付の形式が不正なら絞り込む前に 400 を返す
+        bounds = {}
+        for name, value in (("start", start), ("end", end)):
+            if value is None:
+                continue
+            try:
+                bounds[name] = pd.Timestamp(value)
+            except ValueError:
+                bounds[name] = pd.NaT
+            if pd.isna(bounds[name]):
+                return JSONResponse(content={"error": f"'{name}'の日付'{value}'を解釈できません。"}, status_code=400)
+
+        if CHART_RENDERING == "lazy":
+            # 絞り込み後の集計結果を別のデータセットとして保存し、アップロード時と同じ /charts のURLを返す
+            target_id = filtered_dataset_id(dataset_id, subcategory, start, end) if filtered else dataset_id
+            hit = has_aggregates(target_id)
+            result_cache.record(hit)
+            if hit:
+                return chart_links(target_id, charts)
+        else:
+            filters = {"subcategory": subcategory, "start": start, "end": end, "charts": [c[0] for c in charts]}
+            cache_key = result_cache_key(dataset_id, filters)
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        if filtered and chunks is None:
+            return JSONResponse(content={"error": "集計前データを保持していないため絞り込めません。CSVを再アップロードしてください。"}, status_code=400)
+        if (start is not None or end is not None) and date_column not in chunks[0].columns:
+            return JSONResponse(content={"error": f"CSVに'{date_column}'列がないため期間で絞り込めません。"}, status_code=400)
+
+        def select(df):
+            if subcategory is not None:
+                df = df[df["サブカテゴリ"] == subcategory]
+            if "start" in bounds:
+                df = df[df[date_column] >= bounds["start"]]
+            if "end" in bounds:
+                df = df[df[date_column] <= bounds["end"]]
+            return df
 
+        if filtered:
+            with stage_seconds.time(stage="aggregate"):
+                aggregator = SalesAggregator()
+                for chunk in chunks:
+                    aggregator.update(select(chunk))
+            if aggregator.rows == 0:
+                return JSONResponse(content={"error": "条件に一致する行がありません。"}, status_code=400)
+            agg = aggregator.result()
+            if CHART_RENDERING == "lazy":
+                dataset_store.put(target_id, None, agg, aggregator.rows)
+                save_aggregates(target_id, agg, aggregator.rows)
+        if CHART_RENDERING == "lazy":
+            return chart_links(target_id, charts)
+
+        response, filenames = draw_charts(agg, charts)
+        if len(response) == len(charts):
+            result_cache.put(cache_key, response, filenames)
         return response
 
     except Exception as e:
+        request_errors.inc(endpoint="datasets", status="500")
         return JSONResponse(content={"error": str(e)}, status_code=500)
+
+
+@app.get("/datasets")
+def dataset_stats():
+    return dataset_store.stats()
+
+
+class Job:
+    """バックグラウンドで処理するグラフ生成ジョブの状態"""
+
+    def __init__(self, dataset_id):
+        self.id = uuid.uuid4().hex
+        self.dataset_id = dataset_id
+        self.status = "queued"
+        self.charts = []
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def add_chart(self, item):
+        with self._lock:
+            self.charts.append(item)
+
+    def finish(self, charts):
+        with self._lock:
+            self.charts = list(charts)
+            self.status = "done"
+            self.finished_at = time.time()
+
+    def fail(self, error):
+        with self._lock:
+            self.error = error
+            self.status = "error"
+            self.finished_at = time.time()
+
+    def to_dict(self):
+        with self._lock:
+            order = {chart[0]: index for index, chart in enumerate(CHARTS)}
+            return {
+                "job_id": self.id,
+                "dataset_id": self.dataset_id,
+                "status": self.status,
+                "completed": len(self.charts),
+                "total": len(CHARTS),
+                # 途中経過も含めてグラフの定義順に並べる
+                "charts": sorted(self.charts, key=lambda item: order[item["title"]]),
+                "error": self.error,
+            }
+
+
+jobs = {}
+jobs_lock = threading.Lock()
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="chart-job")
+# 実行中と待機中を合わせたジョブ数の上限
+job_slots = threading.BoundedSemaphore(JOB_WORKERS + JOB_QUEUE_DEPTH)
+
+
+def _register_job(job):
+    with jobs_lock:
+        now = time.time()
+        for job_id in [k for k, j in jobs.items() if j.finished_at and now - j.finished_at > JOB_TTL]:
+            del jobs[job_id]
+        jobs[job.id] = job
+
+
+def _run_job(job, csv_path, encoding, columns):
+    job.status = "running"
+    try:
+        job.finish(generate_charts(csv_path, encoding, columns, job.dataset_id, on_chart=job.add_chart))
+    except EmptyDatasetError as e:
+        # 入力の問題なので、同期APIと同じく 400 として数える
+        request_errors.inc(endpoint="jobs", status="400")
+        job.fail(str(e))
+    except Exception as e:
+        request_errors.inc(endpoint="jobs", status="500")
+        job.fail(str(e))
+    finally:
+        discard_upload(csv_path)
+        job_slots.release()
+
+
+@app.post("/jobs", status_code=202)
+def create_job(file: UploadFile = File(...)):
+    csv_path = None
+    try:
+        csv_path, dataset_id = prepare_upload(file)
+
+        job = Job(dataset_id)
+        cached = cached_charts(dataset_id)
+        if cached is not None:
+            job.finish(cached)
+            _register_job(job)
+            return {"job_id": job.id, "dataset_id": dataset_id, "status": job.status}
+
+        encoding, columns = check_columns(csv_path)
+
+        if not job_slots.acquire(blocking=False):
+            request_errors.inc(endpoint="jobs", status="503")
+            return JSONResponse(content={"error": "処理待ちのジョブが多すぎます。時間をおいて再度お試しください。"}, status_code=503)
+        _register_job(job)
+        job_executor.submit(_run_job, job, csv_path, encoding, columns)
+        # 以降はジョブが読み終えてから削除する
+        csv_path = None
+        return {"job_id": job.id, "dataset_id": dataset_id, "status": job.status}
+
+    except (MissingColumnError, EmptyDatasetError) as e:
+        request_errors.inc(endpoint="jobs", status="400")
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    except Exception as e:
+        request_errors.inc(endpoint="jobs", status="500")
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+    finally:
+        if csv_path is not None:
+            discard_upload(csv_path)
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, stream: bool = False):
+    job = jobs.get(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "ジョブが見つかりません。"}, status_code=404)
+    if not stream:
+        return job.to_dict()
+
+    async def progress():
+        # 1行1JSONで、描画が終わったグラフから順に送る
+        sent = set()
+        while True:
+            state = job.to_dict()
+            for item in state["charts"]:
+                if item["title"] not in sent:
+                    sent.add(item["title"])
+                    yield json.dumps({"event": "chart", **item}, ensure_ascii=False) + "\n"
+            if state["status"] in ("done", "error"):
+                yield json.dumps({"event": state["status"], **state}, ensure_ascii=False) + "\n"
+                return
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+
+    return StreamingResponse(progress(), media_type="application/x-ndjson")